@@ -2,13 +2,17 @@
 #!/usr/bin/env python
 
 # using naming on http://www.gslib.com/gslib_help/programs.html
+import collections
+import io
+import shutil
 import subprocess
-import copy
+import sys
 import pandas as pd
 import pygslib
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 __gamv_par = \
 """                  Parameters for GAMV
@@ -34,8 +38,8 @@ cut[i] is only required if ivtype[i] == 9 or == 10
 
 """
 
-def gamv(parameters, gslib_path = None, silent = False):
-    """gamv(parameters, gslib_path = None)
+def gamv(parameters, gslib_path = None, silent = False, plot = False, tmpdir = None):
+    """gamv(parameters, gslib_path = None, silent = False, plot = False, tmpdir = None)
 
     Funtion to calculate experimental variogram with scattered data using
     the gamv.exe external gslib program.
@@ -47,11 +51,18 @@ def gamv(parameters, gslib_path = None, silent = False):
     gslib_path : string (default None)
         absolute or relative path to gslib excecutable programs
     silent: boolean
-        if true external GSLIB stdout text is printed
+        if false external GSLIB stdout text is printed
+    plot: boolean (default False)
+        if true the variograms are plotted with matplotlib
+    tmpdir: string (default None)
+        directory where the temporary scratch directory is created, None
+        to use the system default (TMPDIR). '/dev/shm' avoids disk writes
+        on linux but must be large enough to hold the input array
 
     Returns
     ------
-    pandas.DataFrame with variograms
+    pandas.DataFrame with variograms, and matplotlib figure and axis
+    (or None, None if plot is False)
 
     Example
     --------
@@ -63,14 +74,14 @@ def gamv(parameters, gslib_path = None, silent = False):
 
 
         parameters = {
-            'datafl' : str or, None, or numpy,     # path to file, or none (to use '_xxx_.in') or numpy array (with columns [x,y])
+            'datafl' : str or, None, or numpy,     # path to file, or none (to use '_xxx_.in') or numpy array (with columns [x,y,z,v...])
             'icolx'  : int,                        # columns for X, Y, Z coordinates
             'icoly'  : int,
             'icolz'  : int,
             'ivar'   : 1D array of int,            # variables column numbers to be used in ivtail and ivhead,
             'tmin'   : float,                      # trimming limits min and max (raws out of this range will be ignored)
             'tmax'   : float,
-            'outfl': str or None,                   # path to the output file or None (to use '_xxx_.out')
+            'outfl': str or None,                   # path to the output file or None (to use a temporary '_xxx_.out')
             'nlag'   : int,                         # number of lags
             'xlag'   : float,                       # lag separation distance
             'xltol'  : float,                       # lag tolerance
@@ -89,6 +100,10 @@ def gamv(parameters, gslib_path = None, silent = False):
                      9 = indicator semivariogram - continuous
                      10= indicator semivariogram - categorical
 
+    Temporary files (input array, parameter file and default output) are
+    written to a private scratch directory (see tmpdir) that is removed
+    on return. This allows concurrent calls.
+
     see http://www.gslib.com/gslib_help/gamv.html for more information
 
     """
@@ -99,49 +114,67 @@ def gamv(parameters, gslib_path = None, silent = False):
         else:
             gslib_path = 'c:\\gslib\\gamv.exe'
 
-    mypar = copy.deepcopy(parameters)
+    workdir = tempfile.mkdtemp(prefix='gamv_', dir=tmpdir)
+    try:
+        return _gamv(parameters, gslib_path, silent, plot, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _gamv(parameters, gslib_path, silent, plot, workdir):
+    """gamv implementation, temporary files are created in workdir"""
+
+    mypar = parameters.copy() # shallow, values are only rebound below
 
     # handle the case where input is an array an not a file
     if isinstance(parameters['datafl'], np.ndarray):
         assert (parameters['datafl'].ndim==2)
 
-        mypar['datafl']='_xxx_.in'
+        mypar['datafl']=os.path.join(workdir, '_xxx_.in')
         mypar['icolx']= 1
         mypar['icoly']= 2
         mypar['icolz']= 3
         mypar['ivar'] = np.arange(4,parameters['datafl'].shape[1]+1,dtype=int)
 
-        with open('_xxx_.in',"w") as f:
-            f.write('temp file '+'\n')
-            f.write('{}'.format(parameters['datafl'].shape[1])+'\n')
-            f.write('x\n')
-            f.write('y\n')
-            f.write('z\n')
-            for i in range(3,parameters['datafl'].shape[1]):
-                f.write('v{}\n'.format(i-2))
-            np.savetxt(f,parameters['datafl'])
+        # drop rows that gamv would trim anyway (all variables out of
+        # [tmin,tmax]); tmin/tmax still go to the par file unchanged
+        data = parameters['datafl']
+        if data.shape[1]>3:
+            v = data[:,3:]
+            data = data[np.any((v>=mypar['tmin']) & (v<=mypar['tmax']), axis=1)]
+
+        # GSLIB header + data, written through a large buffer
+        header = ['temp file \n',
+                  '{}\n'.format(parameters['datafl'].shape[1]),
+                  'x\n', 'y\n', 'z\n']
+        header += ['v{}\n'.format(i-2) for i in range(3,parameters['datafl'].shape[1])]
+        with open(mypar['datafl'],"w", buffering=1<<20) as f:
+            f.writelines(header)
+            np.savetxt(f, data, fmt='%.15g')
     elif parameters['datafl'] is None:
         mypar['datafl']='_xxx_.in'
 
     if mypar['outfl'] is None:
-        mypar['outfl'] = '_xxx_.out'
+        mypar['outfl'] = os.path.join(workdir, '_xxx_.out')
 
-    # handle parameter arrays
-    ivpar = np.array (mypar['ivpar'])
+    # handle parameter arrays, ivpar is split in integer tail, head, type
+    # and a float cut (NaN if not used or not defined)
+    ivpar = np.asarray(mypar['ivpar'])
     ivdir = np.array (mypar['ivdir'])
 
     assert (ivpar.shape[1]==4)
     assert (ivdir.shape[1]==6)
 
-    assert (all([i<=len(mypar['ivar']) for i in ivpar[:,0]]))  # head variable
-    assert (all([i<=len(mypar['ivar']) for i in ivpar[:,1]]))  # tail variable
-    assert (set(ivpar[:,2]).issubset(set([1,2,3,4,5,6,7,8,9,10]))) # ivtype
-    for i in range(ivpar.shape[0]):
-        if ivpar[i,2]<9:
-            ivpar[i,3] = None
-        else:
-            if ivpar[i,3]==None:
-                raise NameError('gslib varmap Error inparameter file: cut[{}]=None'.format(i))
+    cut = np.asarray([np.nan if row[2]<9 or row[3] is None else row[3]
+                      for row in mypar['ivpar']], dtype=np.float64)
+    ivpar = ivpar[:,:3].astype(np.int64)
+
+    nvar = len(mypar['ivar'])
+    assert ((ivpar[:,0]<=nvar).all() and (ivpar[:,1]<=nvar).all())  # tail and head variables
+    assert (np.isin(ivpar[:,2], np.arange(1,11)).all()) # ivtype
+    missing = (ivpar[:,2]>=9) & np.isnan(cut)
+    if missing.any():
+        raise NameError('gslib gamv Error inparameter file: cut[{}]=None'.format(np.flatnonzero(missing)[0]))
 
 
     # prepare parameter file and save it
@@ -149,90 +182,164 @@ def gamv(parameters, gslib_path = None, silent = False):
     mypar['ivar_'] = ' '.join(map(str, mypar['ivar'])) # array to string
 
     mypar['nvarg'] = ivpar.shape[0]
-    mypar['ivpar_'] = pd.DataFrame.to_string(pd.DataFrame(ivpar),index= False, header=False) # array to string
+    mypar['ivpar_'] = '\n'.join('{} {} {} {:.15g}'.format(t, h, v, c)
+                                for (t, h, v), c in zip(ivpar.tolist(), cut.tolist())) # array to string
 
     mypar['ndir'] = ivdir.shape[0]
-    mypar['ivdir_'] = pd.DataFrame.to_string(pd.DataFrame(ivdir),index= False, header=False) # array to string
+    buf = io.StringIO()
+    np.savetxt(buf, ivdir, fmt='%.15g')
+    mypar['ivdir_'] = buf.getvalue().rstrip('\n') # array to string
 
     par = __gamv_par.format(**mypar)
-    print (par)
-    fpar ='_xxx_.par'
+    if not silent:
+        print (par)
+    fpar = os.path.join(workdir, '_xxx_.par')
     with open(fpar,"w") as f:
         f.write(par)
 
     # call pygslib
-    # this construction can be used in a loop for parallel execution
-    p=subprocess.Popen([gslib_path, fpar],
-                       stdout=subprocess.PIPE,
-                       stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    result = p.returncode
-    p.wait()
+    # each call has its own workdir, see gamv_many for parallel execution
+    # on posix with python < 3.10, an absolute executable path,
+    # close_fds=False and no preexec_fn/shell let subprocess use posix_spawn
+    # instead of fork+exec (our pipes are non-inheritable). Newer versions
+    # already use vfork or posix_spawn with the default close_fds=True, and
+    # on windows close_fds=False would let gamv_many children inherit each
+    # other's pipe handles, so the default is kept there
+    exe = os.path.expanduser(gslib_path)
+    exe = os.path.abspath(exe) if os.path.dirname(exe) else (shutil.which(exe) or exe)
+    p=subprocess.Popen([exe, fpar],
+                       stdout=subprocess.PIPE if not silent else subprocess.DEVNULL,
+                       stderr=subprocess.STDOUT if not silent else subprocess.PIPE,
+                       close_fds=not (os.name == 'posix' and sys.version_info < (3, 10)),
+                       bufsize=1,
+                       universal_newlines=True,
+                       errors='replace')
+    # stream GSLIB stdout (and stderr, merged in a single pipe so the child
+    # cannot block on a full stderr pipe) as it arrives instead of buffering it,
+    # keeping the last lines for the error message
+    tail = collections.deque(maxlen=50)
+    try:
+        if p.stdout is not None:
+            for line in p.stdout:
+                sys.stdout.write(line)
+                tail.append(line)
+        if p.stderr is not None:
+            tail.extend(p.stderr.read().splitlines(True))
+        p.wait()
+    except BaseException:
+        # do not leave the child running in a workdir about to be removed
+        p.kill()
+        p.wait()
+        raise
 
     if p.returncode!=0:
-        raise NameError('gslib declus NameError' + str(stderr.decode('utf-8')))
-
-    if ~silent:
-        try:
-            print (stdout.decode('utf-8'))
-        except:
-            print (stdout)
+        raise NameError('gslib gamv NameError' + ''.join(tail))
 
     # put results in pandas
     nvarg = mypar['nvarg']
     ndir = mypar['ndir']
     nlag = mypar['nlag'] + 2
 
-    ignore = np.arange(0,nvarg*ndir*nlag+ndir*nvarg,nlag+1) # list to ignore variogram headers
-    # a) read resulting file
+    names = ['Lag',
+             'average separation',
+             'var funct',
+             'number of pairs',
+             'mean on tail',
+             'mean on head']
     if any(ivpar[:,2]==4):
-        vg = pd.read_csv(mypar['outfl'],
-                        header=None,
-                        skiprows = ignore,
-                        delim_whitespace= True,
-                        names = ['Lag',
-                                'average separation',
-                                'var funct',
-                                'number of pairs',
-                                'mean on tail',
-                                'mean on head',
-                                'variance tail',
-                                'variance head'])
-    else:
-        vg = pd.read_csv(mypar['outfl'],
-                        header=None,
-                        skiprows = ignore,
-                        delim_whitespace= True,
-                        names = ['Lag',
-                                'average separation',
-                                'var funct',
-                                'number of pairs',
-                                'mean on tail',
-                                'mean on head'])
-    # b) add extra variables from headers
-    vg['Variogram'] = np.repeat(range(nvarg), ndir*nlag) # variogram number = row index on parameter['ivpar']
-    vg['Direction'] = np.tile(np.repeat(range(ndir), nlag),nvarg)
-    vg['tail'] = 0
-    vg['head'] = 0
-    vg['type'] = 0
-    vg['cut'] = None
-    for i in range(len(parameters['ivpar'])):
-        vg.loc[vg['Variogram']==i,'tail'] = parameters['ivpar'][i][0]
-        vg.loc[vg['Variogram']==i, 'head'] = parameters['ivpar'][i][1]
-        vg.loc[vg['Variogram']==i, 'type'] = parameters['ivpar'][i][2]
-        vg.loc[vg['Variogram']==i,'cut'] = parameters['ivpar'][i][3]
+        names += ['variance tail',
+                  'variance head']
+    ncols = len(names)
+    # a) read resulting file, the number of rows is known from the parameters
+    n_rows = nvarg*ndir*nlag
+    with open(mypar['outfl']) as f:
+        # variogram headers ('Semivariogram tail:..', 'Covariance ..') start with a letter
+        lines = [l for l in f if l.strip() and not l.lstrip()[0].isalpha()]
+    if len(lines) < n_rows:
+        raise NameError('gslib gamv Error in output file {}: {} data lines, expected {}'.format(
+                        mypar['outfl'], len(lines), n_rows))
+    lines = lines[:n_rows]
+    try:
+        values = np.loadtxt(lines, dtype=np.float64, ndmin=2)
+    except ValueError:
+        # mixed correlogram/other types, short rows are padded with NaN
+        values = np.full((n_rows, ncols), np.nan)
+        for i, l in enumerate(lines):
+            row = l.split()
+            values[i,:len(row)] = np.array(row).astype(np.float64)
+    # b) index with variogram number (= row index on parameter['ivpar']), direction and lag
+    idx = np.arange(n_rows)
+    index = pd.MultiIndex.from_arrays([idx // (ndir*nlag),
+                                       (idx // nlag) % ndir,
+                                       values[:,0].astype(np.int64)],
+                                      names=['Variogram', 'Direction', 'Lag'])
+    vg = pd.DataFrame(values[:,1:], columns=names[1:], index=index)
+    vg['number of pairs'] = vg['number of pairs'].astype(np.int64)
+    meta = pd.DataFrame({'tail': ivpar[:,0],
+                         'head': ivpar[:,1],
+                         'type': ivpar[:,2],
+                         'cut': cut}) # cut is float64 with NaN if not used
+    meta.index.name = 'Variogram'
+    vg = vg.join(meta, on='Variogram')
 
     # clean a bit zeros and variogram at distance zero
-    vg.loc[vg['number of pairs']==0,['var funct','mean on tail','mean on head']]=None
-    vg.loc[vg['average separation']==0,'var funct']=None
-    vg = vg.set_index(['Variogram', 'Direction', 'Lag'])
+    # (NaN instead of None keeps the columns float64)
+    mask = vg['number of pairs'].to_numpy()==0
+    vg.loc[mask,['var funct','mean on tail','mean on head']]=np.nan
+    mask = vg['average separation'].to_numpy()==0
+    vg.loc[mask,'var funct']=np.nan
+
+    if not plot:
+        return vg, None, None
+
     # prepare figure
 
     # TODO add variance line
+    import matplotlib.pyplot as plt
 
     fig, ax = plt.subplots(figsize=(8,6))
-    for i in vg.index.levels[0]:
-        for j in vg.index.levels[1]:
-            vg.loc[i,j].plot(kind='line', x= 'average separation', y = 'var funct', ax=ax, label = 'v{} d{}'.format(i,j))
+    for (i,j), sub in vg.groupby(level=[0,1]):
+        sub.plot(kind='line', x= 'average separation', y = 'var funct', ax=ax, label = 'v{} d{}'.format(i,j))
 
     return vg, fig, ax
+
+
+def gamv_many(param_list, gslib_path = None, silent = True, max_workers = None, tmpdir = None):
+    """gamv_many(param_list, gslib_path = None, silent = True, max_workers = None, tmpdir = None)
+
+    Funtion to run several gamv calls concurrently, for example a
+    directional sweep with one parameter dictionary per direction.
+
+    Parameters
+    ----------
+    param_list : list of dict
+        list of gamv parameter dictionaries (see gamv)
+    gslib_path : string (default None)
+        absolute or relative path to gslib excecutable programs
+    silent: boolean (default True)
+        if false external GSLIB stdout text is printed (interleaved)
+    max_workers: int (default None)
+        maximum number of concurrent gamv processes, None to use
+        the number of processors
+    tmpdir: string (default None)
+        directory for the temporary scratch directories (see gamv)
+
+    Returns
+    ------
+    list of pandas.DataFrame with variograms, in the order of param_list
+
+    Notes
+    ------
+    Each gamv call runs in its own temporary directory, so calls do not
+    share files. Output files (outfl) must be None or different for
+    each parameter dictionary.
+
+    """
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    # gamv is a single threaded external program, threads only wait for it
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(gamv, p, gslib_path, silent, tmpdir=tmpdir) for p in param_list]
+        return [f.result()[0] for f in futures]